@@ -1,250 +1,319 @@
+import io
 import os
-import json
+import sys
 import fitz  # PyMuPDF
+import numpy as np
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from itertools import chain, islice
 from pathlib import Path
 
+# Docker will mount volumes to these paths
+INPUT_DIR = Path("/app/input")
+OUTPUT_DIR = Path("/app/output")
+
+# Number of PDFs processed concurrently
+MAX_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Text extraction flags: skip image blocks and expand ligatures. Without the
+# image blocks MuPDF may merge text blocks an image used to separate, and
+# expanded ligatures change text lengths, so spans and scores can differ from
+# a plain get_text("dict").
+TEXT_FLAGS = (fitz.TEXTFLAGS_DICT
+              & ~fitz.TEXT_PRESERVE_IMAGES
+              & ~fitz.TEXT_PRESERVE_LIGATURES)
+
+# (is_bold, is_italic) for every value of the low byte of a span's font flags
+FONT_FLAG_TABLE = [(bool(f & 2**4), bool(f & 2**1)) for f in range(256)]
+
+# Header/footer regions: top and bottom 5% of the page
+HEADER_Y = 0.95
+FOOTER_Y = 0.05
+
+# Title score weights, shared by score_all and max_title_score
+LARGE_FONT_SCORE = 40      # font size >= 18
+MEDIUM_FONT_SCORE = 20     # font size >= 14
+PAGE_SCORES = (25, 10)     # first and second page
+TOP_OF_PAGE_SCORE = 15
+CENTERED_SCORE = 15
+LEFT_ALIGNED_SCORE = 5
+BOLD_SCORE = 10
+ITALIC_SCORE = 5
+CONCISE_TEXT_SCORE = 10    # 10-100 characters
+LONG_TEXT_PENALTY = 20     # over 200 characters
+ALL_CAPS_SCORE = 8
+WHITESPACE_SCORE = 10
+HEADER_FOOTER_PENALTY = 50
+PAGE_NUMBER_PENALTY = 50
+
+# Per-page span columns, filled in parallel during extraction
+PAGE_COLUMNS = ("texts", "font_sizes", "xs", "ys", "widths", "is_bold", "is_italic")
+EMPTY_PAGE = {key: [] for key in PAGE_COLUMNS}
+
 class TextElement:
-    def __init__(self, text, font_size, x_position, y_position, page_width, page_height, 
+    __slots__ = ('text', 'font_size', 'x_position', 'y_position', 'is_bold',
+                 'is_italic', 'width', 'space_above', 'space_below')
+    
+    def __init__(self, text, font_size, x_position, y_position,
                  is_bold=False, is_italic=False, width=0, space_above=0, space_below=0):
         self.text = text
         self.font_size = font_size
         self.x_position = x_position
         self.y_position = y_position
-        self.page_width = page_width
-        self.page_height = page_height
         self.is_bold = is_bold
         self.is_italic = is_italic
         self.width = width
         self.space_above = space_above
         self.space_below = space_below
 
-def extract_text_elements_from_pdf(pdf_path):
-    """Extract text elements from PDF using PyMuPDF"""
-    doc = fitz.open(pdf_path)
-    pdf_pages = []
+def _page_to_columns(page):
+    """Extract the text spans of a single page as parallel column lists"""
+    page_rect = page.rect
     
-    for page_num in range(min(3, len(doc))):  # Only first 3 pages
-        page = doc[page_num]
-        page_rect = page.rect
-        
-        # Get text with formatting info
-        text_dict = page.get_text("dict")
-        text_elements = []
-        
-        for block in text_dict["blocks"]:
-            if "lines" in block:
-                for line in block["lines"]:
-                    for span in line["spans"]:
-                        # Extract text and formatting
-                        text = span["text"].strip()
-                        if not text:
-                            continue
-                            
-                        # Get font info
-                        font_size = span["size"]
-                        font_flags = span["flags"]
-                        is_bold = bool(font_flags & 2**4)
-                        is_italic = bool(font_flags & 2**1)
-                        
-                        # Get position (normalize to 0-1 range)
-                        bbox = span["bbox"]
-                        x_position = bbox[0] / page_rect.width
-                        y_position = 1 - (bbox[1] / page_rect.height)  # Flip Y axis
-                        width = (bbox[2] - bbox[0]) / page_rect.width
-                        
-                        # Create text element
-                        text_elem = TextElement(
-                            text=text,
-                            font_size=font_size,
-                            x_position=x_position,
-                            y_position=y_position,
-                            page_width=page_rect.width,
-                            page_height=page_rect.height,
-                            is_bold=is_bold,
-                            is_italic=is_italic,
-                            width=width
-                        )
-                        
-                        text_elements.append(text_elem)
-        
-        # Create page object
-        page_obj = type('Page', (), {'text_elements': text_elements})()
-        pdf_pages.append(page_obj)
+    # Get text with formatting info. The TextPage is built once per page so
+    # any further extraction from it reuses the parsed spans.
+    textpage = page.get_textpage(flags=TEXT_FLAGS)
+    text_dict = textpage.extractDICT()
+    texts, font_sizes, xs, ys, widths, is_bold, is_italic = [], [], [], [], [], [], []
+    
+    for block in text_dict["blocks"]:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                # Extract text and formatting
+                text = span["text"].strip()
+                if not text:
+                    continue
+                texts.append(text)
+                    
+                # Get font info
+                font_sizes.append(span["size"])
+                bold, italic = FONT_FLAG_TABLE[span["flags"] & 0xFF]
+                is_bold.append(bold)
+                is_italic.append(italic)
+                
+                # Get position (normalize to 0-1 range)
+                bbox = span["bbox"]
+                xs.append(bbox[0] / page_rect.width)
+                ys.append(1 - (bbox[1] / page_rect.height))  # Flip Y axis
+                widths.append((bbox[2] - bbox[0]) / page_rect.width)
     
-    doc.close()
-    return pdf_pages
+    return {"texts": texts, "font_sizes": font_sizes, "xs": xs, "ys": ys,
+            "widths": widths, "is_bold": is_bold, "is_italic": is_italic}
+
+def page_elements(columns, limit=None):
+    """Build TextElement objects from the first `limit` rows of a page's columns"""
+    rows = zip(columns["texts"], columns["font_sizes"], columns["xs"],
+               columns["ys"], columns["is_bold"], columns["is_italic"],
+               columns["widths"])
+    return [TextElement(*row) for row in islice(rows, limit)]
+
+def iter_pages(doc):
+    """Yield the text spans of an open PDF document, one column dict per page"""
+    for i in range(min(3, len(doc))):  # Only first 3 pages
+        yield _page_to_columns(doc.load_page(i))
 
 def extract_title(pdf_pages):
-    title_candidates = []
+    """Return the best scoring title and its candidate info (None if none)"""
+    best_score, best = 0, None
     
-    for page_num, page in enumerate(pdf_pages):
-        if page_num > 2:
-            break
+    for page_num, columns in enumerate(pdf_pages):
+        texts = columns["texts"]
+        if texts:
+            scores = score_all(
+                font_sizes=np.array(columns["font_sizes"], dtype=np.float64),
+                xs=np.array(columns["xs"], dtype=np.float64),
+                ys=np.array(columns["ys"], dtype=np.float64),
+                widths=np.array(columns["widths"], dtype=np.float64),
+                is_bold=np.array(columns["is_bold"], dtype=bool),
+                is_italic=np.array(columns["is_italic"], dtype=bool),
+                texts=texts,
+                page_num=page_num,
+            )
             
-        for text_element in page.text_elements:
-            score = calculate_title_score(text_element, page_num)
-            if score > 0:
-                title_candidates.append({
-                    'text': text_element.text,
-                    'score': score,
+            # argmax returns the earliest element among equal scores
+            i = int(np.argmax(scores))
+            if scores[i] > best_score:
+                best_score = int(scores[i])
+                best = {
+                    'text': texts[i],
+                    'score': best_score,
                     'page': page_num + 1,
-                    'font_size': text_element.font_size,
-                    'is_bold': text_element.is_bold,
-                    'position': f"({text_element.x_position:.2f}, {text_element.y_position:.2f})"
-                })
+                    'font_size': columns["font_sizes"][i],
+                    'is_bold': columns["is_bold"][i],
+                    'position': f"({columns['xs'][i]:.2f}, {columns['ys'][i]:.2f})"
+                }
+        
+        # Stop before pulling another page once the first 3 are scored or
+        # nothing on the next page could beat the current best
+        if page_num >= 2 or best_score >= max_title_score(page_num + 1):
+            break
     
-    if title_candidates:
-        # Sort by score for debugging
-        title_candidates.sort(key=lambda x: x['score'], reverse=True)
-        return title_candidates[0]['text'], title_candidates
-    return "Untitled Document", []
+    if best:
+        return best['text'], best
+    return "Untitled Document", None
+
+def max_title_score(page_num):
+    """Upper bound of score_all for any element on the given page"""
+    page_bonus = PAGE_SCORES[page_num] if page_num < len(PAGE_SCORES) else 0
+    return (max(LARGE_FONT_SCORE, MEDIUM_FONT_SCORE) + page_bonus
+            + TOP_OF_PAGE_SCORE + max(CENTERED_SCORE, LEFT_ALIGNED_SCORE)
+            + BOLD_SCORE + ITALIC_SCORE + CONCISE_TEXT_SCORE + ALL_CAPS_SCORE
+            + WHITESPACE_SCORE)
 
-def calculate_title_score(text_element, page_num):
-    score = 0
+def score_all(font_sizes, xs, ys, widths, is_bold, is_italic, texts, page_num):
+    """Score every text element of a page at once, returns an int32 array"""
+    # Every bonus added here must also be counted in max_title_score, or the
+    # early exit in extract_title may skip a better title.
+    scores = np.zeros(len(font_sizes), dtype=np.int32)
     
     # 1. Font size (primary factor)
-    if text_element.font_size >= 18:
-        score += 40
-    elif text_element.font_size >= 14:
-        score += 20
+    scores += np.where(font_sizes >= 18, LARGE_FONT_SCORE,
+                       np.where(font_sizes >= 14, MEDIUM_FONT_SCORE, 0))
     
-    # 2. Page position bonus
-    if page_num == 0:  # First page
-        score += 25
-    elif page_num == 1:  # Second page
-        score += 10
+    # 2. Page position bonus (first page, then second page)
+    if page_num < len(PAGE_SCORES):
+        scores += PAGE_SCORES[page_num]
     
     # 3. Vertical position on page
-    if text_element.y_position > 0.7:  # Top 30% of page
-        score += 15
+    scores += np.where(ys > 0.7, TOP_OF_PAGE_SCORE, 0)  # Top 30% of page
     
-    # 4. Horizontal alignment
-    if is_centered(text_element):
-        score += 15
-    elif is_left_aligned(text_element):
-        score += 5
+    # 4. Horizontal alignment: roughly centered on the page, else left aligned
+    centered = np.abs(xs + 0.5 * widths - 0.5) < 0.1
+    scores += np.where(centered, CENTERED_SCORE,
+                       np.where(xs < 0.2, LEFT_ALIGNED_SCORE, 0))
     
     # 5. Text formatting
-    if text_element.is_bold:
-        score += 10
-    if text_element.is_italic:
-        score += 5
+    scores += np.where(is_bold, BOLD_SCORE, 0)
+    scores += np.where(is_italic, ITALIC_SCORE, 0)
     
     # 6. Text length (titles are usually concise)
-    text_length = len(text_element.text.strip())
-    if 10 <= text_length <= 100:
-        score += 10
-    elif text_length > 200:
-        score -= 20  # Penalty for very long text
+    text_lengths = np.array([len(text) for text in texts], dtype=np.int32)
+    scores += np.where((text_lengths >= 10) & (text_lengths <= 100), CONCISE_TEXT_SCORE,
+                       np.where(text_lengths > 200, -LONG_TEXT_PENALTY, 0))
     
     # 7. All caps bonus
-    if text_element.text.isupper() and text_length > 5:
-        score += 8
+    is_upper = np.array([text.isupper() for text in texts], dtype=bool)
+    scores += np.where(is_upper & (text_lengths > 5), ALL_CAPS_SCORE, 0)
     
     # 8. Whitespace isolation
-    if has_significant_whitespace_around(text_element):
-        score += 10
+    scores += np.where(has_significant_whitespace_around(ys), WHITESPACE_SCORE, 0)
     
     # 9. Exclude common non-title patterns
-    if is_header_footer(text_element):
-        score -= 50
-    if is_page_number(text_element):
-        score -= 50
+    scores -= np.where(is_header_footer(ys), HEADER_FOOTER_PENALTY, 0)
+    page_number = np.array([is_page_number(text) for text in texts], dtype=bool)
+    scores -= np.where(page_number, PAGE_NUMBER_PENALTY, 0)
     
-    return score
+    return scores
 
-def is_centered(text_element):
-    # Check if text is roughly centered on the page
-    text_center = text_element.x_position + (text_element.width / 2)
-    page_center = 0.5  # Normalized page center
-    return abs(text_center - page_center) < 0.1
-
-def is_left_aligned(text_element):
-    return text_element.x_position < 0.2
-
-def has_significant_whitespace_around(text_element):
+def has_significant_whitespace_around(ys):
     # Simple heuristic - if text is isolated vertically
-    return text_element.y_position > 0.8 or text_element.y_position < 0.2
+    return (ys > 0.8) | (ys < 0.2)
 
-def is_header_footer(text_element):
+def is_header_footer(ys):
     # Check if text is in header/footer region
-    return (text_element.y_position > 0.95 or  # Top 5%
-            text_element.y_position < 0.05)    # Bottom 5%
+    return (ys > HEADER_Y) | (ys < FOOTER_Y)
+
+def is_page_number(text):
+    # Check if text looks like a page number, cheapest check first
+    return (len(text) <= 3 or
+            text.isdigit() or
+            text[:4].lower() == 'page')
 
-def is_page_number(text_element):
-    # Check if text looks like a page number
-    text = text_element.text.strip()
-    return (text.isdigit() or 
-            text.lower().startswith('page') or
-            len(text) <= 3)
+def _process_one(pdf_path):
+    """Process one PDF, returns (file name, succeeded, stdout log, stderr log)"""
+    # Capture the per-file output so the parent prints it in one piece
+    # instead of interleaving buffered output from several workers.
+    out, err = io.StringIO(), io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        ok = _process_file(pdf_path)
+    return os.path.basename(pdf_path), ok, out.getvalue(), err.getvalue()
+
+def _process_file(pdf_path):
+    """Extract the title of one PDF and write its JSON, returns success"""
+    pdf_file = Path(pdf_path)
+    output_file = OUTPUT_DIR / f"{pdf_file.stem}.json"
+    try:
+        print(f"\n=== Processing {pdf_file.name} ===")
+        
+        # Stream pages into the title scorer, which may stop early
+        with fitz.open(pdf_path, filetype="pdf") as doc:
+            pdf_pages = iter_pages(doc)
+            first_page = next(pdf_pages, EMPTY_PAGE)
+            
+            # Extract title
+            title, candidate = extract_title(chain([first_page], pdf_pages))
+        
+        print(f"Extracted Title: '{title}'")
+        
+        if candidate:
+            print(f"\nBest Title Candidate:")
+            print(f"  '{candidate['text'][:60]}...' (Score: {candidate['score']}, "
+                  f"Font: {candidate['font_size']}, Bold: {candidate['is_bold']}, "
+                  f"Page: {candidate['page']}, Pos: {candidate['position']})")
+        
+        # Show some text elements for debugging
+        if first_page["texts"]:
+            print(f"\nFirst 10 Text Elements (Page 1):")
+            for i, elem in enumerate(page_elements(first_page, 10)):
+                print(f"  {i+1}. '{elem.text[:40]}...' (Font: {elem.font_size}, "
+                      f"Bold: {elem.is_bold}, Pos: ({elem.x_position:.2f}, {elem.y_position:.2f}))")
+        
+        # Create JSON data with extracted title
+        data = {
+            "title": title,
+            "outline": []  # Empty for now as requested
+        }
+        
+        # Create output JSON file
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        
+        return True
+        
+    except Exception as e:
+        print(f"✗ Error processing {pdf_file.name}: {e}")
+        import traceback
+        traceback.print_exc()
+        
+        # Create fallback output
+        fallback_data = {
+            "title": "Untitled Document",
+            "outline": []
+        }
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(fallback_data, option=orjson.OPT_INDENT_2))
+        return False
 
 def process_pdfs():
-    # Docker will mount volumes to these paths
-    input_dir = Path("/app/input")
-    output_dir = Path("/app/output")
-    
     # Create output directory if it doesn't exist
-    output_dir.mkdir(parents=True, exist_ok=True)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     
-    # Get all PDF files
-    pdf_files = list(input_dir.glob("*.pdf"))
+    # Get all PDF files, using the directory entry types to avoid a stat per file
+    with os.scandir(INPUT_DIR) as entries:
+        pdf_paths = [entry.path for entry in entries
+                     if entry.name.endswith(".pdf") and entry.is_file()]
     
-    if not pdf_files:
+    if not pdf_paths:
         print("No PDF files found in /app/input")
         return
     
-    for pdf_file in pdf_files:
-        try:
-            print(f"\n=== Processing {pdf_file.name} ===")
-            
-            # Extract text elements
-            pdf_pages = extract_text_elements_from_pdf(pdf_file)
-            
-            # Extract title
-            title, candidates = extract_title(pdf_pages)
-            
-            print(f"Extracted Title: '{title}'")
-            
-            print(f"\nTop 5 Title Candidates:")
-            for i, candidate in enumerate(candidates[:5]):
-                print(f"  {i+1}. '{candidate['text'][:60]}...' (Score: {candidate['score']}, "
-                      f"Font: {candidate['font_size']}, Bold: {candidate['is_bold']}, "
-                      f"Page: {candidate['page']}, Pos: {candidate['position']})")
-            
-            # Show some text elements for debugging
-            if pdf_pages and pdf_pages[0].text_elements:
-                print(f"\nFirst 10 Text Elements (Page 1):")
-                for i, elem in enumerate(pdf_pages[0].text_elements[:10]):
-                    print(f"  {i+1}. '{elem.text[:40]}...' (Font: {elem.font_size}, "
-                          f"Bold: {elem.is_bold}, Pos: ({elem.x_position:.2f}, {elem.y_position:.2f}))")
-            
-            # Create JSON data with extracted title
-            data = {
-                "title": title,
-                "outline": []  # Empty for now as requested
-            }
-            
-            # Create output JSON file
-            output_file = output_dir / f"{pdf_file.stem}.json"
-            with open(output_file, "w") as f:
-                json.dump(data, f, indent=2)
-            
-            print(f"✓ Created {output_file.name}")
-            
-        except Exception as e:
-            print(f"✗ Error processing {pdf_file.name}: {e}")
-            import traceback
-            traceback.print_exc()
-            
-            # Create fallback output
-            fallback_data = {
-                "title": "Untitled Document",
-                "outline": []
-            }
-            output_file = output_dir / f"{pdf_file.stem}.json"
-            with open(output_file, "w") as f:
-                json.dump(fallback_data, f, indent=2)
-            print(f"✓ Created fallback {output_file.name}")
+    # Parsing is CPU-bound, so spread the files over worker processes.
+    # Only paths cross the process boundary; each worker opens its own doc.
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        for status in ex.map(_process_one, pdf_paths):
+            _report(status)
+
+def _report(status):
+    """Print the output and result line of one processed file"""
+    name, ok, out, err = status
+    print(out, end="")
+    sys.stderr.write(err)
+    stem = os.path.splitext(name)[0]
+    if ok:
+        print(f"✓ Created {stem}.json")
+    else:
+        print(f"✓ Created fallback {stem}.json")
 
 if __name__ == "__main__":
     print("Starting processing pdfs")